@@ -1,17 +1,58 @@
 # config_loader.py
 
 import os
+import re
 import logging
+import sqlite3
+import threading
 import yaml
 
 logger = logging.getLogger(__name__)
 
+# Bump when the layout of the cached OUI table changes
+OUI_DB_VERSION = 1
+
+
+def normalize_oui_prefix(raw):
+    """
+    Turn an OUI file prefix such as '00:1B:C5' or '00:1B:C5:00:00:00/36'
+    into the bare upper-case hex digits it covers ('001BC5', '001BC5000').
+    """
+    prefix, _, bits = raw.partition('/')
+    digits = prefix.replace(':', '').replace('-', '').replace('.', '').upper()
+    if bits:
+        digits = digits[:int(bits) // 4]
+    return digits
+
+
+class OuiTable:
+    """
+    Read-only, dict-style view of an OUI table cached in SQLite.
+    Lookups hit the database lazily instead of loading every row.
+    """
+    def __init__(self, db_file):
+        self._conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+        # Fail fast if the file isn't a usable cache
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version != OUI_DB_VERSION:
+            self._conn.close()
+            raise sqlite3.DatabaseError(f"cache version {version}, expected {OUI_DB_VERSION}")
+        self._conn.execute("SELECT 1 FROM oui LIMIT 1")
+
+    def get(self, prefix, default=None):
+        with self._lock:
+            row = self._conn.execute("SELECT vendor FROM oui WHERE prefix = ?", (prefix,)).fetchone()
+        return row[0] if row else default
+
+
 class ConfigLoader:
-    def __init__(self, oui_file="oui.txt", mappings_file="mappings.yaml"):
+    def __init__(self, oui_file="oui.txt", mappings_file="mappings.yaml", oui_db_file=None):
         self.oui_dict = {}
         self.port_roles = {}
         self.fingerprint_patterns = []
         self.oui_file = oui_file
+        self.oui_db_file = oui_db_file or os.path.splitext(oui_file)[0] + ".sqlite"
         self.mappings_file = mappings_file
 
     def load_all(self):
@@ -23,18 +64,44 @@ class ConfigLoader:
             logger.warning(f"OUI file '{self.oui_file}' not found; MAC lookups may be 'Unknown'.")
             return
 
+        # Reuse the parsed table from a previous run if it's not stale
+        if os.path.isfile(self.oui_db_file) and \
+                os.path.getmtime(self.oui_db_file) >= os.path.getmtime(self.oui_file):
+            try:
+                self.oui_dict = OuiTable(self.oui_db_file)
+                logger.debug(f"Using cached OUI table '{self.oui_db_file}'")
+                return
+            except sqlite3.Error as e:
+                logger.warning(f"OUI cache '{self.oui_db_file}' unusable, re-parsing: {e}")
+
         with open(self.oui_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if not line or line.startswith('#'):
-                    continue
-                parts = line.split('\t')
-                if len(parts) == 2:
-                    mac_prefix, vendor = parts
-                    self.oui_dict[mac_prefix] = vendor.strip()
-                elif len(parts) >= 3:
-                    mac_prefix, _, vendor = parts[0], parts[1], parts[2]
-                    self.oui_dict[mac_prefix] = vendor.strip()
+            lines = f.read().splitlines()
+        # Lines are "prefix<TAB>short<TAB>long[<TAB># comment]" or "prefix<TAB>name";
+        # the vendor is the long name when present, else the second field.
+        # Keys are normalized hex prefixes, so OUI-28/36 ('/28', '/36') entries
+        # are kept at their full length for longest-prefix matching.
+        rows = (line.split('\t', 3) for line in lines if line and line[0] != '#')
+        self.oui_dict = {
+            normalize_oui_prefix(parts[0]): parts[min(len(parts), 3) - 1].strip()
+            for parts in rows if len(parts) >= 2 and parts[0]
+        }
+        self._save_oui_db()
+
+    def _save_oui_db(self):
+        """Write oui_dict to the SQLite cache, replacing any previous copy."""
+        tmp_file = self.oui_db_file + ".tmp"
+        try:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            conn = sqlite3.connect(tmp_file)
+            with conn:
+                conn.execute("CREATE TABLE IF NOT EXISTS oui(prefix TEXT PRIMARY KEY, vendor TEXT)")
+                conn.executemany("INSERT OR REPLACE INTO oui VALUES (?, ?)", self.oui_dict.items())
+                conn.execute(f"PRAGMA user_version = {OUI_DB_VERSION}")
+            conn.close()
+            os.replace(tmp_file, self.oui_db_file)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning(f"Failed writing OUI cache '{self.oui_db_file}': {e}")
 
     def load_mappings(self):
         if not os.path.isfile(self.mappings_file):
@@ -42,6 +109,22 @@ class ConfigLoader:
             return
         with open(self.mappings_file, 'r') as f:
             data = yaml.safe_load(f) or {}
-        self.port_roles = data.get("port_roles", {})
-        self.fingerprint_patterns = data.get("fingerprint_patterns", [])
+        self.port_roles = {}
+        # YAML keys are strings; store them as ints to match scanned ports.
+        for port, role in data.get("port_roles", {}).items():
+            try:
+                self.port_roles[int(port)] = role
+            except ValueError:
+                logger.error(f"Invalid port '{port}' in port_roles; skipping.")
+        self.fingerprint_patterns = []
+        # Compile each regex once here rather than on every host lookup.
+        for entry in data.get("fingerprint_patterns", []):
+            pat = entry.get("regex")
+            if pat:
+                try:
+                    entry["regex"] = re.compile(pat, re.IGNORECASE)
+                except re.error as e:
+                    logger.error(f"Invalid fingerprint regex '{pat}': {e}")
+                    continue
+            self.fingerprint_patterns.append(entry)
 
@@ -1,17 +1,46 @@
 # fingerprint_engine.py
 
+import functools
 import logging
 import re
 import ssl
 import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+try:
+    import hyperscan
+except ImportError:  # optional; falls back to the combined Python regex
+    hyperscan = None
 
 logger = logging.getLogger(__name__)
 
+# Device pages are fetched with verify=False on purpose; don't warn per host.
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
 DEFAULT_VENDOR = "Unknown"
 DEFAULT_ROLE_SLUG = "unknown"
 DEFAULT_DEVICE_TYPE = "Unknown"
 
+# IEEE MAC assignment sizes in hex digits, longest first:
+# MA-S (OUI-36), MA-M (OUI-28), MA-L (OUI-24)
+OUI_PREFIX_LENGTHS = (9, 7, 6)
+
+# Bump when the layout of the fingerprint cache table changes
+FP_CACHE_VERSION = 1
+
+# Vendor banners live in the headers/<title>, so only read the start of a page
+PAGE_READ_BYTES = 65536
+
+# Leading global flags such as "(?i)" are only legal at the very start of a
+# pattern, so they have to become scoped groups inside the alternation.
+_GLOBAL_FLAGS_RE = re.compile(r"^\(\?([aiLmsux]+)\)")
+
 class FingerprintEngine:
     """
     Decides vendor, role slug, device_type based on:
@@ -21,10 +50,54 @@ class FingerprintEngine:
       - TLS certificate CN + page content
       - External regex patterns
     """
-    def __init__(self, oui_dict, port_roles, fingerprint_patterns):
+    def __init__(self, oui_dict, port_roles, fingerprint_patterns, max_workers=20,
+                 cache_file=None, cache_ttl=86400):
         self.oui_dict = oui_dict
+        # Hosts from the same vendor share a prefix; memoize prefix lookups.
+        self._lookup_oui = functools.lru_cache(maxsize=4096)(self._longest_oui_match)
         self.port_roles = port_roles
         self.fingerprint_patterns = fingerprint_patterns
+        self._pattern_rules, self._combined_re = self._build_combined_regex(fingerprint_patterns)
+        self._hs_db = self._build_hyperscan_db(self._pattern_rules)
+        self._hs_local = threading.local()
+        # Hosts are fingerprinted on one pool; the TLS CN probe for each host
+        # runs on a second pool so it can overlap the page fetch without
+        # competing with (and deadlocking against) the per-host workers.
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._probe_executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Building an SSL context loads the system CA bundle, so do it once.
+        self._ssl_ctx = ssl.create_default_context()
+        self._session = requests.Session()
+        self._session.verify = False
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers, max_retries=0)
+        self._session.mount("https://", adapter)
+        # Optional per-IP cache of TLS/page fingerprint results across runs,
+        # so unchanged hosts aren't re-probed within cache_ttl seconds.
+        self._cache_ttl = cache_ttl
+        self._cache_conn = None
+        self._cache_lock = threading.Lock()
+        if cache_file:
+            try:
+                self._cache_conn = sqlite3.connect(cache_file, check_same_thread=False)
+                with self._cache_conn:
+                    version = self._cache_conn.execute("PRAGMA user_version").fetchone()[0]
+                    if version != FP_CACHE_VERSION:
+                        self._cache_conn.execute("DROP TABLE IF EXISTS fp")
+                        self._cache_conn.execute(f"PRAGMA user_version = {FP_CACHE_VERSION}")
+                    self._cache_conn.execute(
+                        "CREATE TABLE IF NOT EXISTS fp("
+                        "ip TEXT PRIMARY KEY, mac TEXT, ts INTEGER, vendor TEXT, device_type TEXT)"
+                    )
+            except sqlite3.Error as e:
+                logger.warning(f"Fingerprint cache '{cache_file}' unusable: {e}")
+                self._cache_conn = None
+
+    def fingerprint_hosts(self, hosts):
+        """
+        Fingerprint a batch of hosts concurrently.
+        Returns a list of results in the same order as 'hosts'.
+        """
+        return list(self._executor.map(self.fingerprint_host, hosts))
 
     def fingerprint_host(self, host_data):
 
@@ -39,28 +112,34 @@ class FingerprintEngine:
 
         # 1) OUI
         if mac:
-            prefix = mac[:8].upper()
-            maybe_vendor = self.oui_dict.get(prefix)
+            digits = mac.strip().replace(':', '').replace('-', '').upper()
+            maybe_vendor = self._lookup_oui(digits[:OUI_PREFIX_LENGTHS[0]])
             if maybe_vendor:
                 logger.debug(f"Found {maybe_vendor} from OUI")
                 vendor = maybe_vendor
 
         # 2) Port-based
-        # If multiple ports match, we take the first. Adjust as needed.
-        for p in open_ports:
-            # port_roles is e.g. { "22": { role=..., device_type=...}, ... }
-            p_str = str(p)
-            if p_str in self.port_roles:
-                role_slug = self.port_roles[p_str].get("role", role_slug)
-                device_type = self.port_roles[p_str].get("device_type", device_type)
+        # If multiple ports match, we take the lowest. Adjust as needed.
+        for p in sorted(open_ports):
+            # port_roles is e.g. { 22: { role=..., device_type=...}, ... }
+            if p in self.port_roles:
+                role_slug = self.port_roles[p].get("role", role_slug)
+                device_type = self.port_roles[p].get("device_type", device_type)
                 logger.debug(f"Found {role_slug}, {device_type} from Ports")
 
                 break
 
         # 3) If port 443 in open_ports, do certificate/page inspection if vendor==Generic or device_type==GenericModel
         if 443 in open_ports and (vendor == DEFAULT_VENDOR or device_type == DEFAULT_DEVICE_TYPE):
-            cn, page_txt = self._fetch_cert_and_page(ip_addr, 443)
-            v2, dt2 = self._regex_fingerprint(cn, page_txt)
+            cached = self._get_cached_fingerprint(ip_addr, mac)
+            if cached:
+                v2, dt2 = cached
+            else:
+                cn, page_txt = self._fetch_cert_and_page(ip_addr, 443)
+                v2, dt2 = self._regex_fingerprint(cn, page_txt)
+                # Don't cache a host that was just unreachable
+                if cn or page_txt:
+                    self._set_cached_fingerprint(ip_addr, mac, v2, dt2)
             logger.debug(f"Found {v2}, {dt2} from TLS")
             if v2 and vendor == DEFAULT_VENDOR:
                 vendor = v2
@@ -77,33 +156,167 @@ class FingerprintEngine:
             "device_type": device_type
         }
 
+    def _longest_oui_match(self, digits):
+        """Return the vendor for the longest OUI prefix of 'digits', or None."""
+        for length in OUI_PREFIX_LENGTHS:
+            vendor = self.oui_dict.get(digits[:length])
+            if vendor:
+                return vendor
+        return None
+
+    def _get_cached_fingerprint(self, ip, mac):
+        """
+        Return a fresh cached (vendor, device_type) for ip, or None.
+        A different MAC behind the same IP (e.g. a new DHCP lease) is a miss.
+        """
+        if not self._cache_conn:
+            return None
+        try:
+            with self._cache_lock:
+                row = self._cache_conn.execute(
+                    "SELECT ts, mac, vendor, device_type FROM fp WHERE ip = ?", (ip,)
+                ).fetchone()
+        except sqlite3.Error as e:
+            logger.debug(f"Failed reading cached fingerprint for {ip}: {e}")
+            return None
+        if row and row[1] == mac and time.time() - row[0] < self._cache_ttl:
+            return (row[2], row[3])
+        return None
+
+    def _set_cached_fingerprint(self, ip, mac, vendor, device_type):
+        if not self._cache_conn:
+            return
+        try:
+            with self._cache_lock, self._cache_conn:
+                self._cache_conn.execute(
+                    "INSERT OR REPLACE INTO fp VALUES (?, ?, ?, ?, ?)",
+                    (ip, mac, int(time.time()), vendor, device_type)
+                )
+        except sqlite3.Error as e:
+            logger.debug(f"Failed caching fingerprint for {ip}: {e}")
+
     def _fetch_cert_and_page(self, ip, port=443, timeout=3):
         """Return (cert_cn, page_text)."""
-        cert_cn = ""
-        page_text = ""
-        # TLS CN
+        # TLS CN probe and page fetch are independent; run them side by side.
+        cn_future = self._probe_executor.submit(self._fetch_cert_cn, ip, port, timeout)
+        page_text = self._fetch_page(ip, port, timeout)
+        return (cn_future.result(), page_text)
+
+    def _fetch_cert_cn(self, ip, port=443, timeout=3):
+        """Return the certificate commonName, or "" if unavailable."""
         try:
-            context = ssl.create_default_context()
             with socket.create_connection((ip, port), timeout=timeout) as sock:
-                with context.wrap_socket(sock, server_hostname=ip) as ssock:
+                with self._ssl_ctx.wrap_socket(sock, server_hostname=ip) as ssock:
                     cert = ssock.getpeercert()
                     subject = cert.get("subject", [])
                     for item in subject:
                         if item[0][0] == "commonName":
-                            cert_cn = item[0][1].lower()
-                            break
+                            return item[0][1].lower()
         except Exception as e:
             logger.debug(f"TLS CN fetch failed for {ip}:{port}: {e}")
+        return ""
 
-        # Page
+    def _fetch_page(self, ip, port=443, timeout=3):
+        """Return the lowercased HTTPS page body, or "" if unavailable."""
         try:
             url = f"https://{ip}:{port}"
-            r = requests.get(url, verify=False, timeout=timeout)
-            page_text = r.text.lower()
+            with self._session.get(url, verify=False, timeout=timeout, stream=True) as r:
+                # A chunked response can yield tiny pieces; keep reading
+                # until the limit rather than stopping at the first one.
+                head = b""
+                for chunk in r.iter_content(PAGE_READ_BYTES):
+                    head += chunk
+                    if len(head) >= PAGE_READ_BYTES:
+                        break
+                head = head[:PAGE_READ_BYTES]
+                return head.decode(r.encoding or "utf-8", errors="replace").lower()
         except Exception as e:
             logger.debug(f"HTTPS page fetch failed for {ip}:{port}: {e}")
+        return ""
+
+    @staticmethod
+    def _build_combined_regex(fingerprint_patterns):
+        """
+        Collapse all usable fingerprint patterns into one alternation with a
+        named group per rule. Returns (rules, combined_re), where rules is a
+        list of (compiled_re, vendor, device_type) in config order.
+        combined_re is None if the patterns cannot be merged safely.
+        """
+        rules = []
+        for entry in fingerprint_patterns:
+            pat = entry.get("regex")
+            vend = entry.get("vendor")
+            dt = entry.get("device_type")
+            if pat and vend and dt:
+                if isinstance(pat, str):
+                    pat = re.compile(pat, re.IGNORECASE)
+                rules.append((pat, vend, dt))
+        if not rules:
+            return rules, None
+        # Merging renumbers capturing groups, so backreferences like \1 would
+        # silently point at the wrong group. Only merge group-free patterns;
+        # write groups as (?:...) to keep the single-pass match.
+        if any(pat.groups for pat, _, _ in rules):
+            logger.info("Fingerprint patterns use capturing groups, matching one by one")
+            return rules, None
+
+        parts = []
+        for i, (pat, _, _) in enumerate(rules):
+            src = _GLOBAL_FLAGS_RE.sub(lambda m: f"(?{m.group(1)}:", pat.pattern, count=1)
+            if src != pat.pattern:
+                src += ")"
+            parts.append(f"(?P<p{i}>{src})")
+        try:
+            combined = re.compile("|".join(parts), re.IGNORECASE)
+        except re.error as e:
+            # e.g. flags that can't be scoped inside the alternation
+            logger.warning(f"Could not combine fingerprint patterns, matching one by one: {e}")
+            combined = None
+        return rules, combined
+
+    @staticmethod
+    def _build_hyperscan_db(rules):
+        """
+        Compile all rule patterns into one Hyperscan block-mode database, or
+        return None if Hyperscan isn't installed or rejects the patterns.
+        Patterns are compiled in prefilter mode, so constructs Hyperscan can't
+        handle exactly (lookarounds, backreferences) still compile; a hit only
+        marks a rule as a candidate to confirm with Python's re.
+        """
+        if hyperscan is None or not rules:
+            return None
+        # UTF8 + UCP give \s, \w and \b the same Unicode meaning they have in
+        # Python's re on str, so the prefilter never misses a real match.
+        flags = (hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH | hyperscan.HS_FLAG_PREFILTER
+                 | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_UCP)
+        try:
+            db = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+            db.compile(
+                expressions=[pat.pattern.encode() for pat, _, _ in rules],
+                ids=list(range(len(rules))),
+                elements=len(rules),
+                flags=[flags] * len(rules),
+            )
+        except hyperscan.error as e:
+            logger.warning(f"Hyperscan rejected fingerprint patterns, using re instead: {e}")
+            return None
+        logger.debug(f"Compiled {len(rules)} fingerprint patterns with Hyperscan")
+        return db
 
-        return (cert_cn, page_text)
+    def _hyperscan_candidates(self, text):
+        """Return the sorted ids of rules Hyperscan flags as possible matches."""
+        # Scratch space can't be shared between concurrent scans
+        scratch = getattr(self._hs_local, "scratch", None)
+        if scratch is None:
+            scratch = self._hs_local.scratch = hyperscan.Scratch(self._hs_db)
+
+        hits = []
+
+        def on_match(rule_id, from_, to, flags, context):
+            hits.append(rule_id)
+
+        self._hs_db.scan(text.encode("utf-8", errors="replace"), match_event_handler=on_match, scratch=scratch)
+        return sorted(hits)
 
     def _regex_fingerprint(self, cert_cn, page_text):
         """
@@ -114,12 +327,27 @@ class FingerprintEngine:
         if not combined.strip():
             return (None, None)
 
-        for entry in self.fingerprint_patterns:
-            pat = entry.get("regex")
-            vend = entry.get("vendor")
-            dt = entry.get("device_type")
-            if pat and vend and dt:
-                if re.search(pat, combined):
+        rules = self._pattern_rules
+        if self._hs_db is not None:
+            # Confirm Hyperscan's candidates in config order; first real match wins.
+            for idx in self._hyperscan_candidates(combined):
+                pat, vend, dt = rules[idx]
+                if pat.search(combined):
                     return (vend, dt)
+            return (None, None)
+
+        if self._combined_re is not None:
+            # One pass over the text decides whether anything matches at all.
+            m = self._combined_re.search(combined)
+            if not m:
+                return (None, None)
+            # The alternation reports the leftmost match, but config order
+            # decides priority; only rules ahead of the hit need re-checking.
+            hit = int(m.lastgroup[1:])
+            rules = rules[:hit + 1]
+
+        for pat, vend, dt in rules:
+            if pat.search(combined):
+                return (vend, dt)
         return (None, None)
 
@@ -1,10 +1,84 @@
 # netbox_manager.py
 
+import functools
+import hashlib
 import logging
+import re
+import threading
+import unicodedata
 import pynetbox
+import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
+# How many values to pack into one filter query during prefetch; keeps the
+# query string well under typical URL length limits.
+PREFETCH_CHUNK = 100
+
+
+# Punctuation dropped outright so e.g. 'Inc.' and '(R)' don't leave dashes
+_SLUG_TABLE = str.maketrans({'.': '', ',': '', '(': '', ')': '', "'": ''})
+# Anything else outside NetBox's ^[-a-zA-Z0-9_]+$ slug rule becomes a dash
+_SLUG_INVALID_RE = re.compile(r"[^a-z0-9_-]+")
+
+
+@functools.lru_cache(maxsize=1024)
+def _slugify(name):
+    """Build the NetBox slug used for platforms, tenants, manufacturers, etc."""
+    # Fold accents to ASCII first ('Knürr' -> 'knurr')
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    slug = _SLUG_INVALID_RE.sub("-", ascii_name.lower().translate(_SLUG_TABLE))
+    slug = re.sub("-{2,}", "-", slug).strip("-")
+    if not slug:
+        # Nothing ASCII left (e.g. a Cyrillic vendor name); keep it unique
+        slug = "x-" + hashlib.sha1(name.encode()).hexdigest()[:8]
+    return slug
+
+
+def _ref_id(value):
+    """Reduce a nested pynetbox Record to its id so it compares with plain ids."""
+    return getattr(value, "id", value)
+
+
+def _diff(record, desired):
+    """
+    Return the subset of 'desired' fields that differ on 'record'.
+    None values are treated as "don't care" and never produce a change.
+    """
+    return {
+        k: v for k, v in desired.items()
+        if v is not None and _ref_id(getattr(record, k, None)) != v
+    }
+
+
+def _locked(key_func):
+    """
+    Run an ensure_* method under a lock for the object it resolves, so two
+    threads can't both create the same object while lookups of different
+    objects still run in parallel. key_func maps the method's arguments to
+    the object's lookup key.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self._key_lock(method.__name__, key_func(*args, **kwargs)):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _TimeoutHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter that applies a default timeout to every request."""
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        return super().send(request, **kwargs)
+
 
 class NetBoxManager:
     """
@@ -12,9 +86,88 @@ class NetBoxManager:
     various NetBox objects. Based on the native .get() and .update()
     approach in pynetbox, but wrapped to reduce code repetition.
     """
-    def __init__(self, url, token):
+    def __init__(self, url, token, pool_size=20, timeout=30):
         self.nb = pynetbox.api(url, token=token)
+        # Size the connection pool to match the number of worker threads so
+        # concurrent host syncs don't block waiting on a free connection, and
+        # give every request a timeout so a stalled call can't hang a worker.
+        session = requests.Session()
+        adapter = _TimeoutHTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, timeout=timeout)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self.nb.http_session = session
+        # Shared catalog objects (platforms, tenants, manufacturers, ...) are
+        # looked up by many hosts at once; get-or-create on each one is
+        # serialized through a per-object lock from _key_lock().
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # Objects resolved by prefetch() or a previous ensure_* call, keyed by
+        # their lookup value. _prefetched records which keys were asked for in
+        # bulk, so a miss on one of those is known not to exist in NetBox.
+        self._cache = {model: {} for model in (
+            "platforms", "manufacturers", "device_types",
+            "device_roles", "devices", "ip_addresses", "interfaces",
+        )}
+        self._prefetched = {model: set() for model in self._cache}
+
+    def _key_lock(self, *key):
+        """Return the lock guarding get-or-create of the object 'key'."""
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
 
+    def prefetch(self, hosts, fingerprints):
+        """
+        Bulk-load the NetBox objects that ensure_* will look up for these
+        hosts, one filter query per model instead of one GET per host.
+        'hosts' and 'fingerprints' are the parallel lists from the scanner
+        and FingerprintEngine.
+        """
+        platforms = {h["os_guess"] or "Unknown" for h in hosts}
+        devices = {h["mac_addr"] or h["ip_addr"] for h in hosts}
+        ips = {f"{h['ip_addr']}/32" for h in hosts}
+        vendors = {fp["vendor"] for fp in fingerprints}
+        models = {fp["device_type"] for fp in fingerprints}
+        roles = {fp["role_slug"] for fp in fingerprints}
+
+        self._prefetch("platforms", self.nb.dcim.platforms, "name", platforms)
+        self._prefetch("manufacturers", self.nb.dcim.manufacturers, "name", vendors)
+        self._prefetch("device_types", self.nb.dcim.device_types, "model", models,
+                       key=lambda dt: (dt.model, dt.manufacturer.id))
+        self._prefetch("device_roles", self.nb.dcim.device_roles, "slug", roles)
+        self._prefetch("devices", self.nb.dcim.devices, "name", devices)
+        self._prefetch("ip_addresses", self.nb.ipam.ip_addresses, "address", ips)
+        # Interfaces of devices that already exist, keyed by (device_id, name)
+        device_ids = [self._cache["devices"][n].id for n in devices if n in self._cache["devices"]]
+        self._prefetch("interfaces", self.nb.dcim.interfaces, "device_id", device_ids,
+                       key=lambda iface: (iface.device.id, iface.name))
+
+    def _prefetch(self, model, endpoint, field, values, key=None):
+        """Filter 'endpoint' by 'field' in chunks and cache the results."""
+        values = sorted(v for v in values if v)
+        for i in range(0, len(values), PREFETCH_CHUNK):
+            chunk = values[i:i + PREFETCH_CHUNK]
+            try:
+                # A list value is sent as repeated query params, which NetBox ORs.
+                for obj in endpoint.filter(**{field: chunk}):
+                    obj_key = key(obj) if key else getattr(obj, field)
+                    self._cache[model][obj_key] = obj
+            except pynetbox.RequestError as e:
+                logger.warning(f"Failed prefetching {model}: {e}")
+                return
+            self._prefetched[model].update(chunk)
+        logger.debug(f"Prefetched {len(self._cache[model])} {model}")
+
+    def _cached(self, model, key, prefetch_key=None):
+        """
+        Return (known, obj) for a lookup. known=True means obj is
+        authoritative (possibly None) and no GET is needed.
+        """
+        obj = self._cache[model].get(key)
+        if obj is not None:
+            return True, obj
+        return (prefetch_key or key) in self._prefetched[model], None
+
+    @_locked(lambda platform_name, update=False: platform_name)
     def ensure_platform(self, platform_name, update=False):
         """
         Get or create a Platform by 'name'.
@@ -23,11 +176,14 @@ class NetBoxManager:
         if not platform_name:
             return None
 
-        # Try to get by name
-        platform_obj = self.nb.dcim.platforms.get(name=platform_name)
+        # Try the cache, then get by name
+        known, platform_obj = self._cached("platforms", platform_name)
+        if not known:
+            platform_obj = self.nb.dcim.platforms.get(name=platform_name)
         if platform_obj:
+            self._cache["platforms"][platform_name] = platform_obj
             if update:
-                slug_val = platform_name.lower().replace(' ', '-').replace('.','').replace('(','')
+                slug_val = _slugify(platform_name)
                 changes = {}
                 if platform_obj.slug != slug_val:
                     changes['slug'] = slug_val
@@ -40,46 +196,59 @@ class NetBoxManager:
             return platform_obj
         else:
             # Create
-            slug_val = platform_name.lower().replace(' ', '-').replace('.','').replace('(','')
+            slug_val = _slugify(platform_name)
             data = {
                 "name": platform_name,
                 "slug": slug_val
             }
             try:
                 new_platform = self.nb.dcim.platforms.create(data)
+                self._cache["platforms"][platform_name] = new_platform
                 logger.info(f"Created platform '{platform_name}'")
                 return new_platform
             except pynetbox.RequestError as e:
                 logger.error(f"Failed creating platform '{platform_name}': {e}")
                 return None
 
-    def ensure_service(self, device_obj, ip_obj, port, protocol='tcp', update=False):
+    def ensure_services(self, device_obj, ip_obj, ports, protocol='tcp', update=False):
         """
-        Creates/updates an ipam.services record for a given device and TCP/UDP port.
+        Creates/updates ipam.services records for a given device and a set of TCP/UDP ports.
         - device_obj: the NetBox device object
         - ip_obj: the NetBox IPAddress object (optional, but typically we want to link the IP)
-        - port: an integer port number
+        - ports: an iterable of integer port numbers
         - protocol: 'tcp', 'udp', etc. (default = 'tcp')
-        - update: bool, if True we update any changed fields on the found service
+        - update: bool, if True we update any changed fields on the found services
 
-        Returns the service object or None on error.
+        Existing services are fetched in one query and missing ones are
+        created with a single bulk POST.
+        Returns the list of service objects (empty on error).
         """
 
         if not device_obj:
-            logger.error("No device object provided to ensure_service().")
-            return None
+            logger.error("No device object provided to ensure_services().")
+            return []
 
-        # We'll form a standard name for the service, e.g. "TCP/443"
-        svc_name = f"{protocol.upper()}/{port}"
+        # We'll form a standard name for each service, e.g. "TCP/443"
+        wanted = {f"{protocol.upper()}/{port}": port for port in ports}
+        if not wanted:
+            return []
 
-        # We'll try to filter by device_id + name
-        existing_services = list(self.nb.ipam.services.filter(
-            device_id=device_obj.id,
-            name=svc_name
-        ))
+        # Fetch all of the device's services in one query and match names
+        # locally; listing every name in the query string can exceed URL
+        # length limits on hosts with many open ports.
+        try:
+            existing_services = list(self.nb.ipam.services.filter(device_id=device_obj.id))
+        except pynetbox.RequestError as e:
+            logger.error(f"Failed fetching services on {device_obj.name}: {e}")
+            return []
 
-        if existing_services:
-            service = existing_services[0]
+        services = []
+        for service in existing_services:
+            svc_name = service.name
+            port = wanted.pop(svc_name, None)
+            if port is None:
+                continue  # not a port we're ensuring, or a duplicate name
+            services.append(service)
             logger.debug(f"Found existing service '{svc_name}' on device '{device_obj.name}'.")
             if update:
                 # Build changes
@@ -103,26 +272,30 @@ class NetBoxManager:
                         logger.info(f"Updated service '{svc_name}' on {device_obj.name} with {changes}.")
                     except pynetbox.RequestError as e:
                         logger.warning(f"Failed updating service '{svc_name}' on {device_obj.name}: {e}")
-            return service
-        else:
-            # Create a new Service
-            data = {
-                "device": device_obj.id,
-                "name": svc_name,
-                "ports": [port],
-                "protocol": protocol,
-                "description": "Auto-created by Nmap script"
-            }
-            if ip_obj:
-                data["ipaddresses"] = [ip_obj.id]
+
+        if wanted:
+            # Create the missing Services in one request
+            data = []
+            for svc_name, port in wanted.items():
+                svc = {
+                    "device": device_obj.id,
+                    "name": svc_name,
+                    "ports": [port],
+                    "protocol": protocol,
+                    "description": "Auto-created by Nmap script"
+                }
+                if ip_obj:
+                    svc["ipaddresses"] = [ip_obj.id]
+                data.append(svc)
 
             try:
-                new_svc = self.nb.ipam.services.create(data)
-                logger.info(f"Created new service '{svc_name}' on device '{device_obj.name}'.")
-                return new_svc
+                created = self.nb.ipam.services.create(data)
+                services.extend(created)
+                logger.info(f"Created {len(data)} new services {sorted(wanted)} on device '{device_obj.name}'.")
             except pynetbox.RequestError as e:
-                logger.error(f"Failed creating service '{svc_name}' on {device_obj.name}: {e}")
-                return None
+                logger.error(f"Failed creating services {sorted(wanted)} on {device_obj.name}: {e}")
+
+        return services
 
     def ensure_prefix(self, prefix_str, site_id=None, update=False):
         """
@@ -163,6 +336,7 @@ class NetBoxManager:
                 logger.error(f"Failed creating prefix {prefix_str}: {e}")
                 return None
 
+    @_locked(lambda name, update=False: name)
     def ensure_tenant(self, name, update=False):
         """
         Get by name; if not found, create. If found and update=True, see if we must update slug or so.
@@ -175,7 +349,7 @@ class NetBoxManager:
                 pass
             return existing
         else:
-            slug_val = name.lower().replace(" ", "-")
+            slug_val = _slugify(name)
             data = {"name": name, "slug": slug_val}
             try:
                 created = self.nb.tenancy.tenants.create(data)
@@ -185,28 +359,34 @@ class NetBoxManager:
                 logger.error(f"Failed creating tenant '{name}': {e}")
                 return None
 
+    @_locked(lambda name, update=False: name)
     def ensure_manufacturer(self, name, update=False):
         """
         Get by name; if not found, create. If found and update=True, see if we must update slug or so.
         """
-        existing = self.nb.dcim.manufacturers.get(name=name)
+        known, existing = self._cached("manufacturers", name)
+        if not known:
+            existing = self.nb.dcim.manufacturers.get(name=name)
         if existing:
+            self._cache["manufacturers"][name] = existing
             logger.debug(f"Found manufacturer {name}")
             if update:
                 # You might compare slug or other fields
                 pass
             return existing
         else:
-            slug_val = name.lower().replace(" ", "-")
+            slug_val = _slugify(name)
             data = {"name": name, "slug": slug_val}
             try:
                 created = self.nb.dcim.manufacturers.create(data)
+                self._cache["manufacturers"][name] = created
                 logger.info(f"Created manufacturer '{name}'")
                 return created
             except pynetbox.RequestError as e:
                 logger.error(f"Failed creating manufacturer '{name}': {e}")
                 return None
 
+    @_locked(lambda model, manufacturer_obj, update=False: (model, getattr(manufacturer_obj, "id", None)))
     def ensure_device_type(self, model, manufacturer_obj, update=False):
         """
         Get by model + manufacturer_id. If none, create.
@@ -216,19 +396,23 @@ class NetBoxManager:
             logger.warning("No manufacturer_obj provided for device_type. Cannot proceed.")
             return None
 
-        existing = self.nb.dcim.device_types.filter(
-            model=model, manufacturer_id=manufacturer_obj.id
-        )
-        existing = list(existing)  # filter returns a generator-like object
-        if existing:
-            dt = existing[0]
+        cache_key = (model, manufacturer_obj.id)
+        known, dt = self._cached("device_types", cache_key, prefetch_key=model)
+        if not known:
+            existing = self.nb.dcim.device_types.filter(
+                model=model, manufacturer_id=manufacturer_obj.id
+            )
+            existing = list(existing)  # filter returns a generator-like object
+            dt = existing[0] if existing else None
+        if dt:
+            self._cache["device_types"][cache_key] = dt
             logger.debug(f"Found device_type '{model}' under '{manufacturer_obj.name}'")
             if update:
                 # compare fields as needed
                 pass
             return dt
         else:
-            slug_val = model.lower().replace(" ", "-")
+            slug_val = _slugify(model)
             data = {
                 "model": model,
                 "slug": slug_val,
@@ -236,19 +420,24 @@ class NetBoxManager:
             }
             try:
                 created = self.nb.dcim.device_types.create(data)
+                self._cache["device_types"][cache_key] = created
                 logger.info(f"Created device_type '{model}' under '{manufacturer_obj.name}'")
                 return created
             except pynetbox.RequestError as e:
                 logger.error(f"Failed creating device_type '{model}': {e}")
                 return None
 
+    @_locked(lambda slug, update=False: slug)
     def ensure_device_role(self, slug, update=False):
         """
         Get by slug or name. If none, create.
         """
-        existing = list(self.nb.dcim.device_roles.filter(slug=slug))
-        if existing:
-            dr = existing[0]
+        known, dr = self._cached("device_roles", slug)
+        if not known:
+            existing = list(self.nb.dcim.device_roles.filter(slug=slug))
+            dr = existing[0] if existing else None
+        if dr:
+            self._cache["device_roles"][slug] = dr
             logger.debug(f"Found device_role '{slug}'")
             if update:
                 # compare fields
@@ -261,6 +450,7 @@ class NetBoxManager:
             }
             try:
                 created = self.nb.dcim.device_roles.create(data)
+                self._cache["device_roles"][slug] = created
                 logger.info(f"Created device_role '{slug}'")
                 return created
             except pynetbox.RequestError as e:
@@ -272,19 +462,19 @@ class NetBoxManager:
         Get device by name; if none, create it.
         If found and update=True, we update role/device_type if needed.
         """
-        existing = self.nb.dcim.devices.get(name=name)
+        known, existing = self._cached("devices", name)
+        if not known:
+            existing = self.nb.dcim.devices.get(name=name)
         if existing:
+            self._cache["devices"][name] = existing
             logger.debug(f"Found device '{name}'")
             if update:
-                changes = {}
-                if role_id and existing.role and existing.role.id != role_id:
-                    changes['role'] = role_id
-                if device_type_id and existing.device_type and existing.device_type.id != device_type_id:
-                    changes['device_type'] = device_type_id
-                if platform_id and existing.platform != platform_id:
-                    changes["platform"] = platform_id
-                if tenant_id and existing.tenant != tenant_id:
-                    changes["tenant"] = tenant_id
+                changes = _diff(existing, {
+                    "role": role_id,
+                    "device_type": device_type_id,
+                    "platform": platform_id,
+                    "tenant": tenant_id,
+                })
                 if changes:
                     try:
                         existing.update(changes)
@@ -303,6 +493,7 @@ class NetBoxManager:
             }
             try:
                 created = self.nb.dcim.devices.create(data)
+                self._cache["devices"][name] = created
                 logger.info(f"Created device '{name}'")
                 return created
             except pynetbox.RequestError as e:
@@ -313,8 +504,11 @@ class NetBoxManager:
         """
         Get IP by address. If none, create.
         """
-        existing = self.nb.ipam.ip_addresses.get(address=ip_str)
+        known, existing = self._cached("ip_addresses", ip_str)
+        if not known:
+            existing = self.nb.ipam.ip_addresses.get(address=ip_str)
         if existing:
+            self._cache["ip_addresses"][ip_str] = existing
             logger.debug(f"Found IP '{ip_str}'")
             # update if needed
             return existing
@@ -322,6 +516,7 @@ class NetBoxManager:
             data = {"address": ip_str}
             try:
                 created = self.nb.ipam.ip_addresses.create(data)
+                self._cache["ip_addresses"][ip_str] = created
                 logger.info(f"Created IP '{ip_str}'")
                 return created
             except pynetbox.RequestError as e:
@@ -333,10 +528,14 @@ class NetBoxManager:
         If we find an interface by device_id + name, or device_id + mac, we re-use it.
         Otherwise we create. Then optionally update.
         """
-        # Minimal approach: first try filter by device_id + name
-        existing_list = list(self.nb.dcim.interfaces.filter(device_id=device_id, name=if_name))
-        if existing_list:
-            iface = existing_list[0]
+        # Minimal approach: try the cache, then filter by device_id + name
+        cache_key = (device_id, if_name)
+        known, iface = self._cached("interfaces", cache_key, prefetch_key=device_id)
+        if not known:
+            existing_list = list(self.nb.dcim.interfaces.filter(device_id=device_id, name=if_name))
+            iface = existing_list[0] if existing_list else None
+        if iface:
+            self._cache["interfaces"][cache_key] = iface
             logger.debug(f"Found interface '{if_name}' on device_id={device_id}")
             if update:
                 changes = {}
@@ -359,6 +558,7 @@ class NetBoxManager:
                 data["mac_address"] = mac_address
             try:
                 created = self.nb.dcim.interfaces.create(data)
+                self._cache["interfaces"][cache_key] = created
                 logger.info(f"Created interface '{if_name}' on device_id={device_id}")
                 return created
             except pynetbox.RequestError as e:
@@ -383,7 +583,7 @@ class NetBoxManager:
 
     def set_primary_ip4(self, device_obj, ip_obj):
         """Set device's primary_ip4 to ip_obj.id."""
-        if device_obj and ip_obj and device_obj.primary_ip4 != ip_obj.id:
+        if device_obj and ip_obj and _diff(device_obj, {"primary_ip4": ip_obj.id}):
             try:
                 device_obj.update({"primary_ip4": ip_obj.id})
                 logger.info(f"Set primary IP of device '{device_obj.name}' to {ip_obj.address}")
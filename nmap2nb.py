@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
+import itertools
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from netbox_manager import NetBoxManager
 from config_loader import ConfigLoader
@@ -21,10 +23,120 @@ SITE_NAME = os.getenv("SITE_NAME")
 TENANT_NAME = os.getenv("TENANT_NAME")
 SUBNETS = os.getenv("SUBNETS") 
 UPDATE_EXISTING = os.getenv("UPDATE_EXISTING", True) 
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", 20))
+NETBOX_TIMEOUT = int(os.getenv("NETBOX_TIMEOUT", 30))
+MAX_SCANS = int(os.getenv("MAX_SCANS", 4))
+FP_CACHE_FILE = os.getenv("FP_CACHE_FILE", "fingerprints.sqlite")
+FP_CACHE_TTL = int(os.getenv("FP_CACHE_TTL", 86400))
+SCAN_BATCH = int(os.getenv("SCAN_BATCH", 32))
+
+def process_host(nbmgr, site_obj, tenant_obj, host_info, fp):
+    """Sync a single scanned and fingerprinted host into NetBox."""
+    ip_addr = host_info["ip_addr"]
+    mac_addr = host_info["mac_addr"]
+    open_ports = host_info["open_ports"]
+    platform = host_info["os_guess"] or "Unknown"
+
+    platform_obj = nbmgr.ensure_platform(platform, update=True)
+
+    # c) Fingerprint result
+    vendor = fp["vendor"]
+    role_slug = fp["role_slug"]
+    dev_type_model = fp["device_type"]
+
+    logger.debug(f"{ip_addr} => vendor={vendor}, role={role_slug}, dev_type={dev_type_model}")
+
+    # d) NetBox manufacturer
+    mfr_obj = nbmgr.ensure_manufacturer(vendor, update=UPDATE_EXISTING)
+    # e) device_type
+    dev_type_obj = None
+    if mfr_obj:
+        dev_type_obj = nbmgr.ensure_device_type(dev_type_model, mfr_obj, update=UPDATE_EXISTING)
+    # f) device_role
+    role_obj = nbmgr.ensure_device_role(role_slug, update=UPDATE_EXISTING)
+
+    # g) device creation
+    # host name can be IP if no better name found
+    hostname = mac_addr or ip_addr
+    if role_obj and dev_type_obj:
+        device_obj = nbmgr.ensure_device(
+            hostname,
+            role_obj.id,
+            dev_type_obj.id,
+            site_obj.id,
+            platform_obj.id,
+            tenant_obj.id,
+            update=UPDATE_EXISTING
+        )
+    else:
+        logger.warning(f"Skipping device creation for {ip_addr} because role or devtype missing.")
+        return
+
+    if not device_obj:
+        return
+
+    # h) IP creation
+    ip_str = f"{ip_addr}/32"
+    ip_obj = nbmgr.ensure_ip(ip_str, update=UPDATE_EXISTING)
+    if not ip_obj:
+        return
+
+    nbmgr.ensure_services(device_obj, ip_obj, open_ports, 'tcp', update=True)
+
+    # i) interface
+    iface_obj = nbmgr.ensure_interface(device_obj.id, if_name="eth0", mac_address=mac_addr, update=UPDATE_EXISTING)
+
+    # j) assign IP to interface
+    nbmgr.assign_ip_to_interface(ip_obj, iface_obj)
+
+    # k) set primary IP
+    nbmgr.set_primary_ip4(device_obj, ip_obj)
+
+
+def sync_subnet(scanner, fpe, nbmgr, executor, site_obj, tenant_obj, cidr):
+    """
+    Stream hosts from an Nmap scan of 'cidr', fingerprinting them and
+    queuing their NetBox sync in batches of SCAN_BATCH while the scan is
+    still running. Returns (scanned, futures): the number of 'up' hosts
+    nmap reported and a dict of submitted futures -> ip_addr. The two differ
+    when a batch fails before its hosts are queued.
+    """
+    scanned = 0
+    futures = {}
+    hosts_iter = scanner.scan_subnet(cidr)
+    try:
+        while True:
+            hosts = []
+            try:
+                hosts = list(itertools.islice(hosts_iter, SCAN_BATCH))
+                if not hosts:
+                    break
+                scanned += len(hosts)
+
+                # c) Fingerprint the batch
+                fingerprints = fpe.fingerprint_hosts(hosts)
+
+                # Resolve existing NetBox objects for the batch up front
+                nbmgr.prefetch(hosts, fingerprints)
+
+                # Each host is a chain of independent NetBox round-trips, so
+                # sync them concurrently.
+                for host_info, fp in zip(hosts, fingerprints):
+                    future = executor.submit(process_host, nbmgr, site_obj, tenant_obj, host_info, fp)
+                    futures[future] = host_info["ip_addr"]
+            except Exception as e:
+                # Keep the batches already queued and move on to the next one
+                ips = ", ".join(h["ip_addr"] for h in hosts) or "no hosts read"
+                logger.error(f"Failed processing a batch from {cidr} ({ips}): {e}")
+    finally:
+        # Stops nmap right away if we bailed out before the scan finished
+        hosts_iter.close()
+    return scanned, futures
+
 
 def main():
     # 1) Initialize NetBox manager, config loader, scanner, fingerprint engine
-    nbmgr = NetBoxManager(NETBOX_URL, NETBOX_TOKEN)
+    nbmgr = NetBoxManager(NETBOX_URL, NETBOX_TOKEN, pool_size=MAX_WORKERS, timeout=NETBOX_TIMEOUT)
     config = ConfigLoader(oui_file="oui.txt", mappings_file="mappings.yaml")
     config.load_all()
 
@@ -32,7 +144,10 @@ def main():
     fpe = FingerprintEngine(
         config.oui_dict,
         config.port_roles,
-        config.fingerprint_patterns
+        config.fingerprint_patterns,
+        max_workers=MAX_WORKERS,
+        cache_file=FP_CACHE_FILE,
+        cache_ttl=FP_CACHE_TTL
     )
 
     # 2) For each subnet
@@ -43,82 +158,49 @@ def main():
         logger.error(f"Site '{SITE_NAME}' not found in NetBox.")
         return
 
-    for cidr in cidr_list:
-        logger.info(f"=== Processing subnet: {cidr} ===")
+    tenant_obj = nbmgr.ensure_tenant(TENANT_NAME, update=True)
 
-        # a) Ensure prefix
+    # a) Ensure prefixes
+    for cidr in cidr_list:
         pref = nbmgr.ensure_prefix(cidr, site_id=site_obj.id, update=UPDATE_EXISTING)
 
-        # b) Scan with Nmap
-        hosts = scanner.scan_subnet(cidr)
-        logger.info(f"Found {len(hosts)} 'up' hosts in {cidr}.")
-
-        for host_info in hosts:
-            ip_addr = host_info["ip_addr"]
-            mac_addr = host_info["mac_addr"]
-            open_ports = host_info["open_ports"]
-            platform = host_info["os_guess"] or "Unknown"
-
-            platform_obj = nbmgr.ensure_platform(platform, update=True)
-
-            tenant_obj = nbmgr.ensure_tenant(TENANT_NAME, update=True)
-
-            # c) Fingerprint
-            fp = fpe.fingerprint_host(host_info)
-            vendor = fp["vendor"]
-            role_slug = fp["role_slug"]
-            dev_type_model = fp["device_type"]
-
-            logger.debug(f"{ip_addr} => vendor={vendor}, role={role_slug}, dev_type={dev_type_model}")
-
-            # d) NetBox manufacturer
-            mfr_obj = nbmgr.ensure_manufacturer(vendor, update=UPDATE_EXISTING)
-            # e) device_type
-            dev_type_obj = None
-            if mfr_obj:
-                dev_type_obj = nbmgr.ensure_device_type(dev_type_model, mfr_obj, update=UPDATE_EXISTING)
-            # f) device_role
-            role_obj = nbmgr.ensure_device_role(role_slug, update=UPDATE_EXISTING)
-
-            # g) device creation
-            # host name can be IP if no better name found
-            hostname = mac_addr or ip_addr
-            if role_obj and dev_type_obj:
-                device_obj = nbmgr.ensure_device(
-                    hostname,
-                    role_obj.id,
-                    dev_type_obj.id,
-                    site_obj.id,
-                    platform_obj.id,
-                    tenant_obj.id,
-                    update=UPDATE_EXISTING
-                )
-            else:
-                logger.warning(f"Skipping device creation for {ip_addr} because role or devtype missing.")
+    # b) Scan subnets with Nmap in parallel. Hosts are streamed out of each
+    # scan and synced to NetBox while the scans are still running.
+    scan_workers = max(1, min(len(cidr_list), MAX_SCANS))
+    with ThreadPoolExecutor(max_workers=scan_workers) as scan_pool, \
+            ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        scans = {
+            scan_pool.submit(sync_subnet, scanner, fpe, nbmgr, executor, site_obj, tenant_obj, cidr): cidr
+            for cidr in cidr_list
+        }
+        pending = {}    # host future -> (cidr, ip_addr)
+        remaining = {}  # cidr -> hosts not yet synced
+        for scan in as_completed(scans):
+            cidr = scans[scan]
+            try:
+                scanned, futures = scan.result()
+            except Exception as e:
+                logger.error(f"Failed scanning {cidr}: {e}")
                 continue
-
-            if not device_obj:
-                continue
-
-            # h) IP creation
-            ip_str = f"{ip_addr}/32"
-            ip_obj = nbmgr.ensure_ip(ip_str, update=UPDATE_EXISTING)
-            if not ip_obj:
-                continue
-
-            for open_port in open_ports:
-                nbmgr.ensure_service(device_obj, ip_obj, open_port, 'tcp', update=True)
-
-            # i) interface
-            iface_obj = nbmgr.ensure_interface(device_obj.id, if_name="eth0", mac_address=mac_addr, update=UPDATE_EXISTING)
-
-            # j) assign IP to interface
-            nbmgr.assign_ip_to_interface(ip_obj, iface_obj)
-
-            # k) set primary IP
-            nbmgr.set_primary_ip4(device_obj, ip_obj)
-
-        logger.info(f"=== Finished {cidr} ===\n")
+            logger.info(f"Found {scanned} 'up' hosts in {cidr}, queued {len(futures)} for NetBox sync.")
+
+            # Don't wait on this subnet's hosts here; collect them and drain
+            # every subnet's host syncs together once all scans are done.
+            for future, ip_addr in futures.items():
+                pending[future] = (cidr, ip_addr)
+            remaining[cidr] = len(futures)
+            if not futures:
+                logger.info(f"=== Finished {cidr} ===\n")
+
+        for future in as_completed(pending):
+            cidr, ip_addr = pending[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Failed processing host {ip_addr}: {e}")
+            remaining[cidr] -= 1
+            if not remaining[cidr]:
+                logger.info(f"=== Finished {cidr} ===\n")
 
     logger.info("All scans completed.")
 
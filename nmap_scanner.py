@@ -1,75 +1,125 @@
 # nmap_scanner.py
 
 import logging
-import nmap
+import subprocess
+import tempfile
+import xml.etree.ElementTree as ET
 
 
 logger = logging.getLogger(__name__)
 
 class NmapScanner:
-    def __init__(self, enable_os_detection=True):
-        self.nm = nmap.PortScanner()
+    def __init__(self, enable_os_detection=True, nmap_path="nmap", host_timeout="30s"):
+        self.nmap_path = nmap_path
         self.enable_os_detection = enable_os_detection
+        self.host_timeout = host_timeout
 
     def scan_subnet(self, cidr):
         """
-        Returns a list of dicts for each 'up' host:
-        [
+        Generator yielding a dict for each 'up' host as nmap reports it:
           {
             "ip_addr": str,
             "mac_addr": str or None,
-            "open_ports": [int, ...],
+            "open_ports": {int, ...},
             "os_guess": str or None
-          }, ...
-        ]
+          }
         """
-        args = "--top-ports 1000 -sS -T4"
+        args = ["--top-ports", "1000", "-sS", "-T4", "--max-retries", "2"]
+        if self.host_timeout:
+            args += ["--host-timeout", self.host_timeout]
         if self.enable_os_detection:
-            args += " -O"
+            # OS detection is the slowest phase; only try it on hosts with
+            # both an open and a closed port (where it can actually succeed),
+            # and only once.
+            args += ["-O", "--osscan-limit", "--max-os-tries", "1"]
 
-        logger.info(f"Scanning {cidr} with args '{args}'")
-        self.nm.scan(cidr, arguments=args)
+        logger.info(f"Scanning {cidr} with args '{' '.join(args)}'")
+        # Run nmap directly and stream its XML through ElementTree's C parser,
+        # so hosts are handed on as soon as nmap finishes them and only one
+        # <host> element is held in memory at a time.
+        cmd = [self.nmap_path, "-oX", "-"] + args + [cidr]
+        with tempfile.TemporaryFile() as stderr:
+            try:
+                # Unbuffered, so reads return as soon as nmap writes a host
+                proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, bufsize=0)
+            except OSError as e:
+                logger.error(f"Failed running nmap for {cidr}: {e}")
+                return
+            try:
+                context = ET.iterparse(proc.stdout, events=("start", "end"))
+                _, root = next(context)
+                for event, elem in context:
+                    if event != "end" or elem.tag != "host":
+                        continue
+                    host = self._parse_host(elem)
+                    # Drop finished hosts from the tree so it doesn't grow
+                    root.clear()
+                    if host:
+                        yield host
+            except (ET.ParseError, StopIteration) as e:
+                logger.error(f"Failed parsing nmap output for {cidr}: {e}")
+            finally:
+                if proc.poll() is None:
+                    proc.terminate()
+                proc.stdout.close()
+                proc.wait()
 
-        results = []
-        for host in self.nm.all_hosts():
-            if self.nm[host].state() == "up":
-                ip_addr = self.nm[host]["addresses"].get("ipv4", host)
-                mac_addr = self.nm[host]["addresses"].get("mac")
-                # gather open TCP ports
-                open_ports = []
-                if "tcp" in self.nm[host]:
-                    for p, pdata in self.nm[host]["tcp"].items():
-                        if pdata["state"] == "open":
-                            open_ports.append(int(p))
+            if proc.returncode:
+                stderr.seek(0)
+                logger.error(f"nmap exited with {proc.returncode} for {cidr}: "
+                             f"{stderr.read().decode(errors='replace').strip()}")
 
-                # OS guess
-                os_guess = None
-                if self.enable_os_detection and "osmatch" in self.nm[host]:
-                   osmatch_list = self.nm[host].get('osmatch', [])
-                   best_accuracy = 0
-                   best_name = None
-                   for entry in osmatch_list:
-                       accuracy_str = entry.get('accuracy', '0')
-                       try:
-                           accuracy_val = int(accuracy_str)
-                       except ValueError:
-                            accuracy_val = 0
+    def _parse_host(self, host_elem):
+        """Build the result dict for one <host> element, or None if not 'up' or timed out."""
+        status = host_elem.find("status")
+        if status is None or status.get("state") != "up":
+            return None
 
-                       if accuracy_val > best_accuracy:
-                            best_accuracy = accuracy_val
-                            best_name = entry.get('name', None)[:25]
+        ip_addr = None
+        mac_addr = None
+        for addr in host_elem.findall("address"):
+            addrtype = addr.get("addrtype")
+            if addrtype == "ipv4" or (addrtype == "ipv6" and not ip_addr):
+                ip_addr = addr.get("addr")
+            elif addrtype == "mac":
+                mac_addr = addr.get("addr")
+        if not ip_addr:
+            return None
 
-                   if best_accuracy >= 85 and best_name:
-                       os_guess = best_name
-                   else:
-                       os_guess = None
+        # A host that hit --host-timeout is reported 'up' but without its
+        # ports or OS; syncing it would overwrite good NetBox data with defaults.
+        if host_elem.get("timedout") == "true":
+            logger.warning(f"Skipping {ip_addr}: nmap host timeout reached before the scan finished")
+            return None
 
+        # gather open TCP ports
+        open_ports = set()
+        for port in host_elem.iterfind("ports/port"):
+            state = port.find("state")
+            if port.get("protocol") == "tcp" and state is not None and state.get("state") == "open":
+                open_ports.add(int(port.get("portid")))
 
-                results.append({
-                    "ip_addr": ip_addr,
-                    "mac_addr": mac_addr,
-                    "open_ports": open_ports,
-                    "os_guess": os_guess
-                })
-        return results
+        # OS guess
+        os_guess = None
+        if self.enable_os_detection:
+            best_accuracy = 0
+            best_name = None
+            for entry in host_elem.iterfind("os/osmatch"):
+                try:
+                    accuracy_val = int(entry.get("accuracy", "0"))
+                except ValueError:
+                    accuracy_val = 0
+
+                if accuracy_val > best_accuracy:
+                    best_accuracy = accuracy_val
+                    best_name = (entry.get("name") or "")[:25]
+
+            if best_accuracy >= 85 and best_name:
+                os_guess = best_name
 
+        return {
+            "ip_addr": ip_addr,
+            "mac_addr": mac_addr,
+            "open_ports": open_ports,
+            "os_guess": os_guess
+        }
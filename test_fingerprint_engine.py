@@ -0,0 +1,92 @@
+# test_fingerprint_engine.py
+
+import os
+import re
+
+import pytest
+
+from config_loader import ConfigLoader
+from fingerprint_engine import FingerprintEngine
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+MAPPINGS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mappings.yaml")
+
+SAMPLE_TEXTS = [
+    "",
+    "nothing to see here",
+    "yealink sip-t46s",
+    "polycom vvx",
+    "the poly phone",
+    "fortigate login",
+    "palo alto networks",
+    "palo\u00a0alto networks",
+    "pan-os",
+    "cp_fw gateway",
+    "junos web",
+    "dell switch",
+    "dell\u00a0switch",
+    "unifi controller",
+    "unified communications",
+    "ui.com",
+    "synology diskstation",
+    "cisco then yealink",
+    "qnap nas — café",
+]
+
+requires_hyperscan = pytest.mark.skipif(hyperscan is None, reason="hyperscan not installed")
+
+
+def _engine(patterns, hyperscan=True, combined=True):
+    engine = FingerprintEngine({}, {}, patterns, max_workers=1)
+    if not hyperscan:
+        engine._hs_db = None
+    if not combined:
+        engine._combined_re = None
+    return engine
+
+
+@pytest.fixture(scope="module")
+def patterns():
+    config = ConfigLoader(mappings_file=MAPPINGS_FILE)
+    config.load_mappings()
+    return config.fingerprint_patterns
+
+
+@pytest.mark.parametrize("text", SAMPLE_TEXTS)
+def test_combined_regex_matches_one_by_one(patterns, text):
+    combined = _engine(patterns, hyperscan=False)
+    one_by_one = _engine(patterns, hyperscan=False, combined=False)
+    assert combined._combined_re is not None
+    assert combined._regex_fingerprint("", text) == one_by_one._regex_fingerprint("", text)
+
+
+def test_config_order_wins_over_text_position(patterns):
+    engine = _engine(patterns, hyperscan=False)
+    assert engine._regex_fingerprint("", "cisco then yealink") == ("Yealink", "Phone")
+
+
+def test_backreferences_are_not_merged():
+    rules = [
+        {"regex": re.compile("(foo)"), "vendor": "A", "device_type": "x"},
+        {"regex": re.compile(r"(bar)\1"), "vendor": "B", "device_type": "x"},
+    ]
+    engine = _engine(rules, hyperscan=False)
+    assert engine._combined_re is None
+    assert engine._regex_fingerprint("", "barbar") == ("B", "x")
+
+
+@requires_hyperscan
+def test_hyperscan_database_builds(patterns):
+    assert _engine(patterns)._hs_db is not None
+
+
+@requires_hyperscan
+@pytest.mark.parametrize("text", SAMPLE_TEXTS)
+def test_hyperscan_matches_re_path(patterns, text):
+    hs_engine = _engine(patterns)
+    re_engine = _engine(patterns, hyperscan=False)
+    assert hs_engine._regex_fingerprint("", text) == re_engine._regex_fingerprint("", text)